@@ -0,0 +1,35 @@
+"""Run every static build stage in order.
+
+Usage:
+    python build.py
+
+Output goes to dist/ (BUILD_DIR overrides it). The server picks up a new build without
+a restart: it switches when dist/build.json, written after the last stage, changes.
+"""
+import sys
+import time
+
+import build_locales
+import build_css
+import build_preload
+import build_sw
+
+STAGES = (
+    ('locales', build_locales.build),
+    ('css', build_css.build),
+    ('preload', build_preload.build),
+    ('sw', build_sw.build),
+)
+
+
+def build(build_dir=build_locales.BUILD_DIR):
+    for name, stage in STAGES:
+        started = time.perf_counter()
+        print('[%s]' % name)
+        stage(build_dir)
+        print('[%s] done in %.2fs' % (name, time.perf_counter() - started))
+    build_locales.write_stamp(build_dir)
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else build_locales.BUILD_DIR)
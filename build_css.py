@@ -0,0 +1,484 @@
+"""Prune, deduplicate and split the inline CSS of the built pages.
+
+Usage:
+    python build_css.py        # after build_locales.py, or run build.py for every stage
+
+index.html is a SingleFile export: nearly all of its weight is <style> blocks inside four
+declarative shadow roots (<template shadowrootmode="open">), each carrying its stylesheets
+twice and many rules for elements that are not there. For every style scope (the document
+and each shadow root) this stage:
+
+- drops selectors that match no element in that scope, then rules left with no selectors,
+  then @font-face / @keyframes nobody references;
+- removes earlier copies of rules that are repeated verbatim (the later copy wins anyway);
+- keeps the result inline for the above-the-fold scopes (the document and the first
+  CRITICAL_SHADOW_ROOTS shadow roots) and moves it to a content-hashed stylesheet under
+  dist/css/, loaded without blocking render, for the rest.
+
+Matching is deliberately conservative: combinators, pseudo-classes and attribute selectors
+are ignored, any class or id that appears in a page script counts as present, and so does
+any tag the scripts create, because they add elements and classes at runtime.
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import hashlib
+from html.parser import HTMLParser
+
+from build_locales import BUILD_DIR, LOCALE_MANIFEST, write_stamp
+
+CSS_PAGES = ('index.html',)
+CSS_DIR = 'css'
+# served from /css/build/ by pages.serve_build_asset
+CSS_URL_PREFIX = 'css/build/'
+CRITICAL_SHADOW_ROOTS = int(os.environ.get('CRITICAL_SHADOW_ROOTS', 1))
+
+STYLE_RE = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.DOTALL | re.IGNORECASE)
+TEMPLATE_RE = re.compile(r'<template\b([^>]*)>|</template\s*>', re.IGNORECASE)
+CSP_STYLE_SRC_RE = re.compile(r"(style-src)([^;\"]*)")
+NAME_RE = re.compile(r'[A-Za-z_][\w-]*')
+GROUPING_AT_RULES = ('@media', '@supports', '@layer', '@container', '@document')
+URL_RE = re.compile(r'url\(\s*(["\']?)([^"\')]+)\1\s*\)')
+
+
+# --- CSS ------------------------------------------------------------------------------
+
+def _skip_string(css, i):
+    quote = css[i]
+    i += 1
+    while i < len(css) and css[i] != quote:
+        i += 2 if css[i] == '\\' else 1
+    return i + 1
+
+
+def strip_comments(css):
+    out = []
+    i = 0
+    while i < len(css):
+        c = css[i]
+        if c in '"\'':
+            j = _skip_string(css, i)
+            out.append(css[i:j])
+            i = j
+        elif css.startswith('/*', i):
+            end = css.find('*/', i + 2)
+            i = len(css) if end == -1 else end + 2
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def squash(text):
+    """Collapse whitespace outside strings."""
+    out = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in '"\'':
+            j = _skip_string(text, i)
+            out.append(text[i:j])
+            i = j
+        elif c.isspace():
+            while i < len(text) and text[i].isspace():
+                i += 1
+            out.append(' ')
+        else:
+            out.append(c)
+            i += 1
+    return re.sub(r'\s*([{};,>])\s*', r'\1', ''.join(out)).strip()
+
+
+def parse_blocks(css):
+    """Split CSS (comments already removed) into top-level (prelude, body) pairs.
+
+    body is None for statement at-rules such as @import or @charset.
+    """
+    blocks = []
+    i = 0
+    start = 0
+    while i < len(css):
+        c = css[i]
+        if c in '"\'':
+            i = _skip_string(css, i)
+        elif c == ';':
+            prelude = css[start:i].strip()
+            if prelude:
+                blocks.append((prelude, None))
+            i += 1
+            start = i
+        elif c == '{':
+            depth = 1
+            j = i + 1
+            while j < len(css) and depth:
+                if css[j] in '"\'':
+                    j = _skip_string(css, j)
+                    continue
+                if css[j] == '{':
+                    depth += 1
+                elif css[j] == '}':
+                    depth -= 1
+                j += 1
+            blocks.append((css[start:i].strip(), css[i + 1:j - 1]))
+            i = j
+            start = i
+        else:
+            i += 1
+    return blocks
+
+
+def split_selectors(prelude):
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(prelude):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(prelude[start:i].strip())
+            start = i + 1
+    parts.append(prelude[start:].strip())
+    return [p for p in parts if p]
+
+
+def _strip_functional_pseudos(selector):
+    # :not(...), :is(...), ::slotted(...), :nth-child(...) -> ''
+    while True:
+        m = re.search(r'::?[\w-]+\(', selector)
+        if not m:
+            return selector
+        depth = 1
+        j = m.end()
+        while j < len(selector) and depth:
+            depth += {'(': 1, ')': -1}.get(selector[j], 0)
+            j += 1
+        selector = selector[:m.start()] + selector[j:]
+
+
+def compounds(selector):
+    """Return [(tag, classes, ids)] for each compound selector, or None to always keep."""
+    if '\\' in selector or ':host' in selector or ':root' in selector:
+        return None
+    selector = _strip_functional_pseudos(selector)
+    selector = re.sub(r'\[[^\]]*\]', '', selector)
+    selector = re.sub(r'::?[\w-]+', '', selector)
+    out = []
+    for part in re.split(r'\s*[>+~]\s*|\s+', selector.strip()):
+        if not part:
+            continue
+        tag = re.match(r'[A-Za-z][\w-]*|\*', part)
+        out.append((tag.group(0).lower() if tag and tag.group(0) != '*' else None,
+                    re.findall(r'\.([\w-]+)', part), re.findall(r'#([\w-]+)', part)))
+    return out
+
+
+# --- HTML -----------------------------------------------------------------------------
+
+class Scope:
+    def __init__(self):
+        self.elements = []
+        self.by_class = {}
+        self.by_id = {}
+        self.tags = set()
+        self.inline_styles = []
+
+    def add(self, tag, attrs):
+        classes = set((attrs.get('class') or '').split())
+        el = (tag, classes, attrs.get('id'))
+        self.elements.append(el)
+        self.tags.add(tag)
+        for c in classes:
+            self.by_class.setdefault(c, []).append(el)
+        if el[2]:
+            self.by_id.setdefault(el[2], []).append(el)
+        if attrs.get('style'):
+            self.inline_styles.append(attrs['style'])
+
+
+class ScopeCollector(HTMLParser):
+    """Collect elements per style scope (0 = document, n = n-th shadow root) and script text."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.scopes = [Scope()]
+        self.stack = [0]
+        self.templates = []
+        self.scripts = []
+        self.in_script = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((k, v or '') for k, v in attrs)
+        self.scopes[self.stack[-1]].add(tag, attrs)
+        self.scripts.extend(v for k, v in attrs.items() if k.startswith('on'))
+        if tag == 'template':
+            shadow = 'shadowrootmode' in attrs
+            if shadow:
+                self.scopes.append(Scope())
+                self.stack.append(len(self.scopes) - 1)
+            self.templates.append(shadow)
+        elif tag == 'script':
+            self.in_script = True
+
+    def handle_endtag(self, tag):
+        if tag == 'template' and self.templates:
+            if self.templates.pop():
+                self.stack.pop()
+        elif tag == 'script':
+            self.in_script = False
+
+    def handle_data(self, data):
+        if self.in_script:
+            self.scripts.append(data)
+
+
+def style_blocks(html):
+    """Yield (match, scope index) for every <style> element, using the same scope numbering."""
+    events = [(m.start(), 'template', m) for m in TEMPLATE_RE.finditer(html)]
+    events += [(m.start(), 'style', m) for m in STYLE_RE.finditer(html)]
+    events.sort(key=lambda e: e[0])
+    stack = [0]
+    templates = []
+    count = 0
+    for _, kind, m in events:
+        if kind == 'style':
+            yield m, stack[-1]
+        elif m.group(0).startswith('</'):
+            if templates and templates.pop():
+                stack.pop()
+        else:
+            shadow = 'shadowrootmode' in (m.group(1) or '')
+            if shadow:
+                count += 1
+                stack.append(count)
+            templates.append(shadow)
+
+
+# --- pruning --------------------------------------------------------------------------
+
+class Pruner:
+    def __init__(self, scope, dynamic_names, dynamic_tags):
+        self.scope = scope
+        self.dynamic = dynamic_names
+        self.dynamic_tags = dynamic_tags
+        self.kept_text = []
+        self.stats = {'selectors': 0, 'selectors_kept': 0}
+
+    def _compound_present(self, tag, classes, ids):
+        if any(n in self.dynamic for n in classes + ids):
+            return True
+        if tag and tag not in self.scope.tags and tag not in self.dynamic_tags:
+            return False
+        if ids:
+            candidates = self.scope.by_id.get(ids[0], [])
+        elif classes:
+            candidates = self.scope.by_class.get(classes[0], [])
+        else:
+            return True
+        for el_tag, el_classes, el_id in candidates:
+            if tag and el_tag != tag:
+                continue
+            if all(c in el_classes for c in classes) and all(i == el_id for i in ids):
+                return True
+        return False
+
+    def selector_present(self, selector):
+        parts = compounds(selector)
+        if parts is None:
+            return True
+        return all(self._compound_present(*p) for p in parts)
+
+    def prune(self, blocks):
+        """First pass: style rules and grouping at-rules; font-face/keyframes kept as-is."""
+        out = []
+        for prelude, body in blocks:
+            lower = prelude.lower()
+            if body is None or lower.startswith(('@font-face', '@keyframes', '@-webkit-keyframes', '@page', '@counter-style', '@property')):
+                out.append((prelude, body))
+            elif lower.startswith(GROUPING_AT_RULES):
+                inner = self.prune(parse_blocks(body))
+                if inner:
+                    out.append((prelude, inner))
+            elif prelude.startswith('@'):
+                out.append((prelude, body))
+            else:
+                selectors = split_selectors(prelude)
+                kept = [s for s in selectors if self.selector_present(s)]
+                self.stats['selectors'] += len(selectors)
+                self.stats['selectors_kept'] += len(kept)
+                if kept:
+                    out.append((','.join(kept), body))
+                    self.kept_text.append(body)
+        return out
+
+    def drop_unreferenced(self, blocks, referenced):
+        out = []
+        for prelude, body in blocks:
+            lower = prelude.lower()
+            if isinstance(body, list):
+                body = self.drop_unreferenced(body, referenced)
+                if body:
+                    out.append((prelude, body))
+            elif lower.startswith('@font-face'):
+                family = re.search(r'font-family\s*:\s*([^;]+)', body or '', re.IGNORECASE)
+                if not family or family.group(1).strip().strip('"\'').lower() in referenced:
+                    out.append((prelude, body))
+            elif lower.startswith(('@keyframes', '@-webkit-keyframes')):
+                if prelude.split(None, 1)[-1].strip().lower() in referenced:
+                    out.append((prelude, body))
+            else:
+                out.append((prelude, body))
+        return out
+
+
+def dedupe(blocks):
+    """Drop earlier verbatim repeats of a rule in the same context; the last copy wins anyway."""
+    seen = set()
+    out = []
+    for prelude, body in reversed(blocks):
+        if isinstance(body, list):
+            body = dedupe(body)
+        key = (prelude, json.dumps(body))
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append((prelude, body))
+    return list(reversed(out))
+
+
+def serialize(blocks):
+    out = []
+    for prelude, body in blocks:
+        if body is None:
+            out.append(squash(prelude) + ';')
+        elif isinstance(body, list):
+            out.append(squash(prelude) + '{' + serialize(body) + '}')
+        else:
+            out.append(squash(prelude) + '{' + squash(body) + '}')
+    return ''.join(out)
+
+
+def optimize_scope(css, scope, dynamic_names, dynamic_tags, script_text):
+    pruner = Pruner(scope, dynamic_names, dynamic_tags)
+    blocks = pruner.prune(parse_blocks(strip_comments(css)))
+    usage = ' '.join(pruner.kept_text + scope.inline_styles + [script_text]).lower()
+    referenced = set(n.lower() for n in NAME_RE.findall(usage))
+    for families in re.findall(r'font(?:-family)?\s*:\s*([^;}]+)', usage):
+        referenced |= set(f.strip().strip('"\'') for f in families.split(','))
+    blocks = pruner.drop_unreferenced(blocks, referenced)
+    return serialize(dedupe(blocks)), pruner.stats
+
+
+# --- page rewrite ---------------------------------------------------------------------
+
+def _allow_self_styles(html):
+    # the pages' CSP only allowed inline styles; hashed stylesheets are same-origin
+    def fix(m):
+        sources = m.group(2)
+        return m.group(0) if "'self'" in sources else m.group(1) + " 'self'" + sources
+    return CSP_STYLE_SRC_RE.sub(fix, html, count=1)
+
+
+def optimize_page(html, critical_roots=CRITICAL_SHADOW_ROOTS):
+    """Return (new html, {scope: css}, report) for one page."""
+    collector = ScopeCollector()
+    collector.feed(html)
+    collector.close()
+    script_text = '\n'.join(collector.scripts)
+    dynamic_names = set(NAME_RE.findall(script_text))
+    dynamic_tags = set(t.lower() for t in re.findall(r'''createElement\(\s*['"]([\w-]+)''', script_text))
+
+    by_scope = {}
+    for m, scope in style_blocks(html):
+        by_scope.setdefault(scope, []).append(m)
+
+    report = {'css_in': 0, 'css_inline': 0, 'css_external': 0, 'selectors': 0, 'selectors_kept': 0}
+    external = {}
+    edits = []
+    for scope, matches in by_scope.items():
+        source = '\n'.join(m.group(1) for m in matches)
+        css, stats = optimize_scope(source, collector.scopes[scope], dynamic_names, dynamic_tags, script_text)
+        report['css_in'] += len(source)
+        report['selectors'] += stats['selectors']
+        report['selectors_kept'] += stats['selectors_kept']
+        if scope <= critical_roots:
+            replacement = '<style>%s</style>' % css if css else ''
+            report['css_inline'] += len(css)
+        else:
+            external[scope] = css
+            report['css_external'] += len(css)
+            replacement = '{{css:%d}}' % scope
+        edits.append((matches[0].start(), matches[0].end(), replacement))
+        edits.extend((m.start(), m.end(), '') for m in matches[1:])
+
+    out = []
+    last = 0
+    for start, end, replacement in sorted(edits):
+        out.append(html[last:start])
+        out.append(replacement)
+        last = end
+    out.append(html[last:])
+    return _allow_self_styles(''.join(out)), external, report
+
+
+def rebase_urls(css, prefix):
+    """Make page-relative url()s resolve from a stylesheet at CSS_URL_PREFIX."""
+    def fix(m):
+        url = m.group(2).strip()
+        if re.match(r'^([a-z][\w+.-]*:|/|#)', url, re.IGNORECASE):
+            return m.group(0)
+        return 'url(%s%s%s%s)' % (m.group(1), prefix, url, m.group(1))
+    return URL_RE.sub(fix, css)
+
+
+def write_stylesheet(build_dir, page, scope, css):
+    css = rebase_urls(css, '../' * CSS_URL_PREFIX.count('/'))
+    digest = hashlib.sha256(css.encode('utf-8')).hexdigest()[:12]
+    name = '%s.%d.%s.css' % (os.path.splitext(page)[0], scope, digest)
+    path = os.path.join(build_dir, CSS_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(css)
+        # precompressed copy, picked by pages.serve_build_asset
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(css.encode('utf-8'), compresslevel=9))
+    return CSS_URL_PREFIX + name
+
+
+def async_stylesheet(href):
+    return ('<link rel="stylesheet" href="%s" media="print" onload="this.media=\'all\'">'
+            '<noscript><link rel="stylesheet" href="%s"></noscript>' % (href, href))
+
+
+def build(build_dir=BUILD_DIR):
+    with open(os.path.join(build_dir, LOCALE_MANIFEST), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    for page in CSS_PAGES:
+        if page not in manifest['pages']:
+            continue
+        for locale in manifest['locales']:
+            path = os.path.join(build_dir, locale, page)
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                html = f.read()
+            if 'data-css-optimized' in html:
+                continue
+            new_html, external, report = optimize_page(html)
+            for scope, css in external.items():
+                link = async_stylesheet(write_stylesheet(build_dir, page, scope, css)) if css else ''
+                new_html = new_html.replace('{{css:%d}}' % scope, link, 1)
+            new_html = re.sub(r'<html\b', '<html data-css-optimized', new_html, count=1)
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(new_html)
+            print('%s [%s]: html %d -> %d bytes; css %d -> %d inline + %d external; selectors %d -> %d' % (
+                page, locale, len(html.encode('utf-8')), len(new_html.encode('utf-8')),
+                report['css_in'], report['css_inline'], report['css_external'],
+                report['selectors'], report['selectors_kept']))
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
+    write_stamp(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
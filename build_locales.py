@@ -0,0 +1,145 @@
+"""Render fully translated static variants of the site pages, one directory per locale.
+
+Usage:
+    python build_locales.py
+
+Reads assets/translations.js and writes dist/<locale>/<page> for every locale found there
+(BUILD_DIR overrides dist/). The server (see pages.py) picks a variant per request from
+the site_lang cookie or Accept-Language, so text is correct on first paint and the
+client-side rewrite in index.html only runs when the visitor switches language.
+
+- Pages in TRANSLATED_PAGES get the same substitutions the in-page script does:
+  elements with data-i18n="key" and text nodes that exactly match an English string.
+- Pages in LOCALIZED_COPIES already exist as hand-maintained <page>_<locale>.html files;
+  they are copied in so e.g. /legal.html is served directly instead of via a JS redirect.
+"""
+import os
+import re
+import json
+import time
+from html import unescape
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.environ.get('BUILD_DIR') or os.path.join(APP_ROOT, 'dist')
+TRANSLATIONS_JS = os.path.join(APP_ROOT, 'assets', 'translations.js')
+LOCALE_MANIFEST = 'locales.json'
+# written last, once every stage is done; the server only switches builds when it changes
+BUILD_STAMP = 'build.json'
+DEFAULT_LOCALE = 'en'
+
+TRANSLATED_PAGES = ('index.html',)
+LOCALIZED_COPIES = ('legal.html', 'privacy.html', 'terms.html')
+
+ROW_RE = re.compile(r"\{\s*key\s*:\s*'((?:[^'\\]|\\.)*)'\s*,(.*?)\}", re.DOTALL)
+FIELD_RE = re.compile(r"(\w+)\s*:\s*'((?:[^'\\]|\\.)*)'")
+# leaf elements only: the replaced content must not contain markup
+I18N_ELEMENT_RE = re.compile(r'(<(\w+)\b[^>]*\sdata-i18n="([^"]+)"[^>]*>)([^<]*)(</\2\s*>)')
+RAW_BLOCK_RE = re.compile(r'(<(script|style)\b.*?</\2\s*>)', re.DOTALL | re.IGNORECASE)
+TEXT_NODE_RE = re.compile(r'>([^<>]+)<')
+HTML_TAG_RE = re.compile(r'<html\b[^>]*>', re.IGNORECASE)
+
+
+def _js_unescape(value):
+    return re.sub(r'\\(.)', lambda m: {'n': '\n', 't': '\t'}.get(m.group(1), m.group(1)), value)
+
+
+def _html_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def load_translations(path=TRANSLATIONS_JS):
+    """Parse translations.js into {locale: {key: text}}."""
+    with open(path, 'r', encoding='utf-8') as f:
+        source = f.read()
+    out = {}
+    for match in ROW_RE.finditer(source):
+        key = _js_unescape(match.group(1))
+        for locale, text in FIELD_RE.findall(match.group(2)):
+            out.setdefault(locale.lower(), {})[key] = _js_unescape(text)
+    return out
+
+
+def translate_html(html, locale, translations):
+    """Return `html` with every translatable string rendered in `locale`."""
+    strings = translations.get(locale, {})
+    english = translations.get(DEFAULT_LOCALE, {})
+    by_english = {text.strip(): key for key, text in english.items() if text.strip()}
+    missing = set()
+
+    def element(match):
+        open_tag, _, key, inner, close_tag = match.groups()
+        if key not in strings:
+            missing.add(key)
+            return match.group(0)
+        # keep the surrounding whitespace so the markup layout is unchanged
+        lead = inner[:len(inner) - len(inner.lstrip())]
+        trail = inner[len(inner.rstrip()):]
+        return open_tag + lead + _html_escape(strings[key]) + trail + close_tag
+
+    def text_node(match):
+        text = match.group(1)
+        key = by_english.get(unescape(text.strip()))
+        if not key or key not in strings:
+            return match.group(0)
+        return '>' + text.replace(text.strip(), _html_escape(strings[key])) + '<'
+
+    parts = RAW_BLOCK_RE.split(html)
+    out = []
+    # split() with two groups yields [text, block, tagname, text, block, tagname, ...]
+    for i in range(0, len(parts), 3):
+        chunk = I18N_ELEMENT_RE.sub(element, parts[i])
+        out.append(TEXT_NODE_RE.sub(text_node, chunk))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    html = ''.join(out)
+    html = HTML_TAG_RE.sub(lambda m: _set_html_lang(m.group(0), locale), html, count=1)
+    return html, missing
+
+
+def _set_html_lang(tag, locale):
+    tag = re.sub(r'\s(lang|data-prerendered-lang)="[^"]*"', '', tag)
+    return tag[:-1].rstrip() + ' lang="%s" data-prerendered-lang="%s">' % (locale, locale)
+
+
+def _write(path, html):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(html)
+
+
+def build(build_dir=BUILD_DIR):
+    started = time.perf_counter()
+    translations = load_translations()
+    locales = sorted(translations)
+    pages = []
+    for page in TRANSLATED_PAGES:
+        with open(os.path.join(APP_ROOT, page), 'r', encoding='utf-8', newline='') as f:
+            source = f.read()
+        for locale in locales:
+            html, missing = translate_html(source, locale, translations)
+            if missing:
+                print('  %s [%s]: no translation for %s' % (page, locale, ', '.join(sorted(missing))))
+            _write(os.path.join(build_dir, locale, page), html)
+        pages.append(page)
+    for page in LOCALIZED_COPIES:
+        stem = os.path.splitext(page)[0]
+        for locale in locales:
+            src = os.path.join(APP_ROOT, '%s_%s.html' % (stem, locale))
+            if not os.path.exists(src):
+                src = os.path.join(APP_ROOT, '%s_%s.html' % (stem, DEFAULT_LOCALE))
+            with open(src, 'r', encoding='utf-8', newline='') as f:
+                _write(os.path.join(build_dir, locale, page), f.read())
+        pages.append(page)
+    manifest = {'default': DEFAULT_LOCALE, 'locales': locales, 'pages': pages, 'built': int(time.time())}
+    _write(os.path.join(build_dir, LOCALE_MANIFEST), json.dumps(manifest, indent=2))
+    print('Built %d pages x %d locales into %s in %.2fs' % (len(pages), len(locales), build_dir, time.perf_counter() - started))
+    return manifest
+
+
+def write_stamp(build_dir=BUILD_DIR):
+    _write(os.path.join(build_dir, BUILD_STAMP), json.dumps({'built': time.time()}))
+
+
+if __name__ == '__main__':
+    build()
+    write_stamp()
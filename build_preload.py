@@ -0,0 +1,237 @@
+"""Build the per-page dependency graph used for preload hints.
+
+Usage:
+    python build_preload.py    # after build_css.py, or run build.py for every stage
+
+Scans each page for what the first screen needs: render-blocking stylesheets and
+scripts, the fonts the inline (critical) CSS will actually load, and the first images
+in the above-the-fold scopes. Fonts are resolved the way the browser does it. The
+last @font-face for a given family/style/weight/stretch/unicode-range wins, and a
+face only counts if a critical rule uses its family, weight and style. It writes dist/preload.json. For each page it stores the full
+dependency list and the top PRELOAD_LIMIT hints. pages.py turns those into a cached
+`Link: rel=preload` header and reloads them when preload.json changes.
+
+Built pages are scanned in their default-locale variant (all variants share the same
+assets); other pages are scanned from the source tree.
+"""
+import os
+import re
+import sys
+import json
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+from build_locales import BUILD_DIR, LOCALE_MANIFEST, APP_ROOT, write_stamp
+from build_css import CRITICAL_SHADOW_ROOTS, URL_RE, strip_comments
+
+PRELOAD_MANIFEST = 'preload.json'
+PRELOAD_LIMIT = int(os.environ.get('PRELOAD_LIMIT', 6))
+PRELOAD_IMAGES = 2
+PRELOAD_FONTS = 3
+SOURCE_PAGES = ('index.html', 'login.html', 'signup.html', 'dashboard.html')
+# lower sorts first: blocking resources, then fonts, then images
+PRIORITY = {'preconnect': 0, 'style': 1, 'script': 2, 'font': 3, 'image': 4}
+FONT_TYPES = {'.woff2': 'font/woff2', '.woff': 'font/woff', '.ttf': 'font/ttf', '.otf': 'font/otf'}
+FONT_FACE_RE = re.compile(r'@font-face\s*\{([^}]*)\}', re.IGNORECASE)
+FONT_WEIGHTS = {'normal': 400, 'bold': 700}
+
+
+def _descriptor(block, name):
+    m = re.search(r'(?:^|[;{\s])%s\s*:\s*([^;}]+)' % re.escape(name), block, re.IGNORECASE)
+    return ' '.join(m.group(1).split()).lower() if m else None
+
+
+def _family_name(value):
+    return value.strip().strip('"\'').lower()
+
+
+def _weights(value):
+    """Numeric weights in a font-weight value (a face may declare a range, e.g. "100 900")."""
+    out = []
+    for token in (value or '').split():
+        if token in FONT_WEIGHTS:
+            out.append(FONT_WEIGHTS[token])
+        elif token.isdigit():
+            out.append(int(token))
+    return out
+
+
+def used_font_styles(css):
+    """Families, weights and styles requested by the ordinary (non-@font-face) rules in `css`."""
+    css = FONT_FACE_RE.sub('', css)
+    families = []
+    # 400/normal is what every element without an explicit weight or style renders with
+    weights = {400}
+    styles = {'normal'}
+    for m in re.finditer(r'(?:^|[;{\s])font-family\s*:\s*([^;}]+)', css, re.IGNORECASE):
+        families.append([_family_name(f) for f in m.group(1).split(',')])
+    for m in re.finditer(r'(?:^|[;{\s])font\s*:\s*([^;}]+)', css, re.IGNORECASE):
+        # shorthand: [style] [weight] size[/line-height] family[, family...]
+        head, _, rest = m.group(1).partition(',')
+        tokens = head.split()
+        if len(tokens) >= 2:
+            families.append([_family_name(tokens[-1])] + [_family_name(f) for f in rest.split(',') if rest])
+            weights.update(_weights(' '.join(tokens[:-1])))
+            styles.update(t for t in tokens if t in ('italic', 'oblique'))
+    for m in re.finditer(r'(?:^|[;{\s])font-weight\s*:\s*([^;}]+)', css, re.IGNORECASE):
+        weights.update(_weights(m.group(1).strip().lower()))
+    for m in re.finditer(r'(?:^|[;{\s])font-style\s*:\s*([^;}]+)', css, re.IGNORECASE):
+        styles.add(m.group(1).split()[0].lower())
+    return families, weights, styles
+
+
+def resolve_fonts(css, limit=PRELOAD_FONTS):
+    """Font URLs the browser will fetch for `css`, at most `limit`, in declaration order."""
+    css = strip_comments(css)
+    faces = {}
+    for block in FONT_FACE_RE.findall(css):
+        m = URL_RE.search(block)
+        family = _descriptor(block, 'font-family')
+        if not m or not family:
+            continue
+        key = (_family_name(family), _descriptor(block, 'font-style') or 'normal',
+               _descriptor(block, 'font-weight') or '400', _descriptor(block, 'font-stretch') or 'normal',
+               _descriptor(block, 'unicode-range') or '')
+        # a later face with the same descriptors replaces the earlier one
+        faces.pop(key, None)
+        faces[key] = m.group(2).strip()
+    declared = set(key[0] for key in faces)
+    families, weights, styles = used_font_styles(css)
+    # the first family in each list that has a face is the one that gets loaded
+    used = set(next((f for f in stack if f in declared), None) for stack in families)
+    urls = []
+    for (family, style, weight, _, _), url in faces.items():
+        face_weights = _weights(weight) or [400]
+        if family not in used or style not in styles:
+            continue
+        if not any(min(face_weights) <= w <= max(face_weights) for w in weights):
+            continue
+        if url.startswith('data:') or url in urls:
+            continue
+        urls.append(url)
+    return urls[:limit]
+
+
+class DependencyScanner(HTMLParser):
+    def __init__(self, critical_roots=CRITICAL_SHADOW_ROOTS):
+        super().__init__(convert_charrefs=True)
+        self.critical_roots = critical_roots
+        self.scope_stack = [0]
+        self.templates = []
+        self.roots = 0
+        self.in_style = False
+        self.deps = []
+        self.images = 0
+        self.critical_css = []
+
+    @property
+    def critical(self):
+        return self.scope_stack[-1] <= self.critical_roots
+
+    def add(self, kind, href, **extra):
+        if not href or href.startswith(('data:', '#', 'javascript:')):
+            return
+        dep = dict(extra, kind=kind, href=href)
+        if dep not in self.deps:
+            self.deps.append(dep)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((k, v or '') for k, v in attrs)
+        if tag == 'template':
+            shadow = 'shadowrootmode' in attrs
+            if shadow:
+                self.roots += 1
+                self.scope_stack.append(self.roots)
+            self.templates.append(shadow)
+        elif tag == 'style':
+            self.in_style = True
+        elif not self.critical:
+            return
+        elif tag == 'link' and 'stylesheet' in attrs.get('rel', '').split():
+            # media-swapped stylesheets are deliberately non-blocking; don't promote them
+            if attrs.get('media', 'all') in ('all', 'screen', ''):
+                self.add('style', attrs.get('href'))
+        elif tag == 'script' and attrs.get('src') and 'async' not in attrs and 'defer' not in attrs:
+            self.add('script', attrs['src'])
+        elif tag == 'img' and attrs.get('src') and attrs.get('loading') != 'lazy' and self.images < PRELOAD_IMAGES:
+            if not attrs['src'].startswith('data:'):
+                self.images += 1
+                self.add('image', attrs['src'])
+
+    def handle_endtag(self, tag):
+        if tag == 'template' and self.templates:
+            if self.templates.pop():
+                self.scope_stack.pop()
+        elif tag == 'style':
+            self.in_style = False
+
+    def handle_data(self, data):
+        if self.in_style and self.critical:
+            self.critical_css.append(data)
+
+    def close(self):
+        super().close()
+        for url in resolve_fonts('\n'.join(self.critical_css)):
+            self.add('font', url, type=FONT_TYPES.get(os.path.splitext(urlsplit(url).path)[1].lower()))
+
+
+def scan_page(html, page):
+    scanner = DependencyScanner()
+    scanner.feed(html)
+    scanner.close()
+    base = '/' + page
+    deps = []
+    origins = []
+    for dep in scanner.deps:
+        href = urljoin(base, dep['href'])
+        parts = urlsplit(href)
+        if parts.scheme in ('http', 'https'):
+            # cross-origin: warm the connection instead of preloading
+            origin = '%s://%s' % (parts.scheme, parts.netloc)
+            if origin not in origins:
+                origins.append(origin)
+            continue
+        deps.append(dict(dep, href=href))
+    deps += [{'kind': 'preconnect', 'href': origin} for origin in origins]
+    return deps
+
+
+def link_value(dep):
+    if dep['kind'] == 'preconnect':
+        # stylesheets/scripts/images are fetched without CORS, so no crossorigin here
+        return '<%s>; rel=preconnect' % dep['href']
+    value = '<%s>; rel=preload; as=%s' % (dep['href'], dep['kind'])
+    if dep.get('type'):
+        value += '; type="%s"' % dep['type']
+    if dep['kind'] == 'font':
+        # fonts are always fetched in CORS mode; without this the preload is wasted
+        value += '; crossorigin'
+    return value
+
+
+def build(build_dir=BUILD_DIR):
+    built = {}
+    manifest_path = os.path.join(build_dir, LOCALE_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        built = {page: os.path.join(build_dir, manifest['default'], page) for page in manifest['pages']}
+    graph = {}
+    for page in sorted(set(SOURCE_PAGES) | set(built)):
+        path = built.get(page) or os.path.join(APP_ROOT, page)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            deps = scan_page(f.read(), page)
+        top = sorted(deps, key=lambda d: PRIORITY[d['kind']])[:PRELOAD_LIMIT]
+        graph[page] = {'dependencies': deps, 'links': [link_value(d) for d in top]}
+        print('%s: %d dependencies, %d hinted' % (page, len(deps), len(top)))
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, PRELOAD_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(graph, f, indent=2)
+    return graph
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
+    write_stamp(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
@@ -0,0 +1,236 @@
+"""Generate the service worker (dist/sw.js) from the asset inventory.
+
+Usage:
+    python build_sw.py    # after the other stages, or run build.py for every stage
+
+Every file under assets/ is hashed. The shell is precached on install: fonts and
+sprites (PRECACHE_EXTENSIONS), the shared scripts/stylesheets and the content-hashed
+CSS from build_css.py. Each entry is stored under its content revision, so a deploy only
+downloads what actually changed. HTML pages are precached too, then served
+stale-while-revalidate. Other files under /assets/ are cached on first use. /api/* and
+other NEVER_CACHE paths are never touched by the worker.
+
+VERSION is a hash of the whole inventory and the built pages. Any change produces a
+new sw.js. The browser installs it and the old page and runtime caches are dropped
+when it activates.
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+
+from build_locales import APP_ROOT, BUILD_DIR, LOCALE_MANIFEST, write_stamp
+from build_css import CSS_DIR, CSS_URL_PREFIX
+from build_preload import SOURCE_PAGES
+
+SW_FILE = 'sw.js'
+ASSETS_DIR = 'assets'
+PRECACHE_EXTENSIONS = ('.woff2', '.woff', '.svg')
+SHELL_FILES = ('assets/translations.js', 'css/listing.css')
+PAGES = ('/',) + tuple('/' + page for page in SOURCE_PAGES)
+NEVER_CACHE = ('/api/', '/webhook', '/' + SW_FILE)
+STYLESHEET_REF_RE = re.compile(re.escape(CSS_URL_PREFIX) + r'([\w.-]+\.css)')
+
+WORKER = r"""/* Generated by build_sw.py; do not edit. */
+'use strict';
+var VERSION = __VERSION__;
+// path -> content revision
+var PRECACHE = __PRECACHE__;
+var PAGES = __PAGES__;
+var NEVER_CACHE = __NEVER_CACHE__;
+// shell entries are keyed by revision, so this cache survives deploys
+var SHELL_CACHE = 'fynelis-shell';
+var PAGES_CACHE = 'fynelis-pages-' + VERSION;
+var RUNTIME_CACHE = 'fynelis-runtime-' + VERSION;
+
+function revisionKey(path) {
+	return path + '?__rev=' + PRECACHE[path];
+}
+
+function cacheable(resp) {
+	return resp.ok && resp.type === 'basic' && !resp.redirected;
+}
+
+self.addEventListener('install', function (event) {
+	event.waitUntil(caches.open(SHELL_CACHE).then(function (shell) {
+		return Promise.all(Object.keys(PRECACHE).map(function (path) {
+			var key = revisionKey(path);
+			return shell.match(key).then(function (hit) {
+				if (hit) return;
+				return fetch(path, { cache: 'no-cache' }).then(function (resp) {
+					if (!cacheable(resp)) throw new Error('precache ' + path + ': ' + resp.status);
+					return shell.put(key, resp);
+				});
+			});
+		}));
+	}).then(function () {
+		return caches.open(PAGES_CACHE);
+	}).then(function (pages) {
+		// pages are best effort: a missing one is fetched on first navigation instead
+		return Promise.all(PAGES.map(function (path) {
+			return fetch(path, { credentials: 'same-origin' }).then(function (resp) {
+				if (cacheable(resp)) return pages.put(path, resp);
+			}).catch(function () {});
+		}));
+	}).then(function () {
+		return self.skipWaiting();
+	}));
+});
+
+self.addEventListener('activate', function (event) {
+	var keep = [SHELL_CACHE, PAGES_CACHE, RUNTIME_CACHE];
+	var wanted = {};
+	Object.keys(PRECACHE).forEach(function (path) {
+		wanted[new URL(revisionKey(path), self.location.origin).href] = true;
+	});
+	event.waitUntil(caches.keys().then(function (names) {
+		return Promise.all(names.filter(function (name) {
+			return name.indexOf('fynelis-') === 0 && keep.indexOf(name) === -1;
+		}).map(function (name) {
+			return caches.delete(name);
+		}));
+	}).then(function () {
+		return caches.open(SHELL_CACHE);
+	}).then(function (shell) {
+		return shell.keys().then(function (requests) {
+			return Promise.all(requests.filter(function (req) {
+				return !wanted[req.url];
+			}).map(function (req) {
+				return shell.delete(req);
+			}));
+		});
+	}).then(function () {
+		return self.clients.claim();
+	}));
+});
+
+function staleWhileRevalidate(event, key) {
+	return caches.open(PAGES_CACHE).then(function (pages) {
+		// the server varies HTML on Cookie/Accept-Language; index.html clears this cache on a language switch
+		return pages.match(key, { ignoreVary: true }).then(function (hit) {
+			var network = fetch(event.request).then(function (resp) {
+				if (!cacheable(resp)) return resp;
+				return pages.put(key, resp.clone()).then(function () { return resp; });
+			});
+			if (!hit) return network;
+			event.waitUntil(network.catch(function () {}));
+			return hit;
+		});
+	});
+}
+
+function cacheFirst(req) {
+	return caches.open(RUNTIME_CACHE).then(function (runtime) {
+		return runtime.match(req).then(function (hit) {
+			return hit || fetch(req).then(function (resp) {
+				if (cacheable(resp)) runtime.put(req, resp.clone());
+				return resp;
+			});
+		});
+	});
+}
+
+self.addEventListener('fetch', function (event) {
+	var req = event.request;
+	if (req.method !== 'GET') return;
+	var url = new URL(req.url);
+	if (url.origin !== self.location.origin) return;
+	if (NEVER_CACHE.some(function (prefix) { return url.pathname.indexOf(prefix) === 0; })) return;
+	if (PRECACHE.hasOwnProperty(url.pathname)) {
+		event.respondWith(caches.open(SHELL_CACHE).then(function (shell) {
+			return shell.match(revisionKey(url.pathname)).then(function (hit) { return hit || fetch(req); });
+		}));
+	} else if (PAGES.indexOf(url.pathname) !== -1 || (req.mode === 'navigate' && /\.html$/.test(url.pathname))) {
+		event.respondWith(staleWhileRevalidate(event, url.pathname));
+	} else if (url.pathname.indexOf('/assets/') === 0) {
+		event.respondWith(cacheFirst(req));
+	}
+});
+"""
+
+
+def file_revision(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def inventory(build_dir=BUILD_DIR):
+    """Return ({url: revision} to precache, {path: revision} of everything else versioned)."""
+    precache = {}
+    others = {}
+    assets = os.path.join(APP_ROOT, ASSETS_DIR)
+    for name in sorted(os.listdir(assets)):
+        path = os.path.join(assets, name)
+        if not os.path.isfile(path):
+            continue
+        rel = '%s/%s' % (ASSETS_DIR, name)
+        if rel in SHELL_FILES or os.path.splitext(name)[1].lower() in PRECACHE_EXTENSIONS:
+            precache['/' + rel] = file_revision(path)
+        else:
+            others[rel] = file_revision(path)
+    for rel in SHELL_FILES:
+        path = os.path.join(APP_ROOT, rel)
+        if os.path.exists(path):
+            precache['/' + rel] = file_revision(path)
+    # pages aren't precached by revision (their HTML varies per visitor) but still version the worker
+    for page in SOURCE_PAGES:
+        path = os.path.join(APP_ROOT, page)
+        if os.path.exists(path):
+            others[page] = file_revision(path)
+    stylesheets = set()
+    manifest_path = os.path.join(build_dir, LOCALE_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        for locale in manifest['locales']:
+            for page in manifest['pages']:
+                path = os.path.join(build_dir, locale, page)
+                if os.path.exists(path):
+                    others['%s/%s' % (locale, page)] = file_revision(path)
+                    with open(path, 'r', encoding='utf-8') as f:
+                        stylesheets.update(STYLESHEET_REF_RE.findall(f.read()))
+    # build_css.py output, served from /css/build/. dist/css also keeps stylesheets from
+    # earlier builds (old cached HTML may still point at them); only the current pages' are precached
+    for name in sorted(stylesheets):
+        path = os.path.join(build_dir, CSS_DIR, name)
+        if os.path.exists(path):
+            precache['/' + CSS_URL_PREFIX + name] = file_revision(path)
+    return precache, others
+
+
+def render_worker(precache, version):
+    values = {
+        '__VERSION__': json.dumps(version),
+        '__PRECACHE__': json.dumps(precache, indent=1, sort_keys=True),
+        '__PAGES__': json.dumps(list(PAGES)),
+        '__NEVER_CACHE__': json.dumps(list(NEVER_CACHE)),
+    }
+    out = WORKER
+    for token, value in values.items():
+        out = out.replace(token, value)
+    return out
+
+
+def build(build_dir=BUILD_DIR):
+    precache, others = inventory(build_dir)
+    digest = hashlib.sha256()
+    for name, rev in sorted(list(precache.items()) + list(others.items())):
+        digest.update(('%s %s\n' % (name, rev)).encode('utf-8'))
+    version = digest.hexdigest()[:12]
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, SW_FILE), 'w', encoding='utf-8', newline='\n') as f:
+        f.write(render_worker(precache, version))
+    size = sum(os.path.getsize(os.path.join(APP_ROOT, url.lstrip('/'))) for url in precache
+               if not url.startswith('/css/build/'))
+    print('%s: version %s, %d precached files (%d KB), %d versioned files' % (
+        SW_FILE, version, len(precache), size // 1024, len(others)))
+    return version
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
+    write_stamp(sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR)
@@ -0,0 +1,92 @@
+"""gzip/brotli compression for Flask responses.
+
+Usage:
+    from compression import init_compression
+    init_compression(app)
+
+Only buffered responses of a compressible type and at least COMPRESS_MIN_SIZE bytes
+are compressed. Static files served with send_from_directory stream from disk
+(direct passthrough) and are left untouched. Brotli is used when the optional
+`brotli` package is installed and the client accepts it; gzip otherwise.
+"""
+import os
+import gzip
+
+# Optional: brotli if installed
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except Exception:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+    'image/svg+xml',
+)
+
+
+def choose_encoding(accept_encoding):
+    """Pick 'br' or 'gzip' from an Accept-Encoding header, or None."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        bits = part.strip().split(';')
+        name = bits[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in bits[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    if BROTLI_AVAILABLE and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', accepted.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+
+def init_compression(app, min_size=COMPRESS_MIN_SIZE):
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        if 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if not encoding:
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress_body(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # a strong validator must differ per representation; weak ones may be shared
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag('%s-%s' % (etag, encoding))
+        return response
+
+    return app
@@ -0,0 +1,320 @@
+"""Local IP -> country lookup used to pick the site language without a third-party call.
+
+The database is a CSV of inclusive IP ranges, one per line:
+
+    start_ip,end_ip,country
+    1.0.0.0,1.0.0.255,AU
+
+(the format of the free DB-IP "IP to Country Lite" download). It is loaded into
+compact sorted arrays and searched with bisect. `fetch` also compiles the arrays into
+<csv>.bin, so loading takes milliseconds instead of a multi-second parse. The servers
+load the table at startup. After that the file's mtime is checked at most every
+GEOIP_REFRESH seconds, so a cron job can replace it in place. A changed file is
+reloaded on a background thread while lookups keep using the old table. Lookups never
+touch the network.
+
+Usage:
+    python geoip.py fetch             # download the current DB-IP lite file to GEOIP_DB
+    python geoip.py lookup 8.8.8.8    # resolve an address against GEOIP_DB
+"""
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import bisect
+import ipaddress
+import threading
+import urllib.request
+from array import array
+from datetime import datetime
+from functools import lru_cache
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+GEOIP_DB = os.environ.get('GEOIP_DB') or os.path.join(APP_ROOT, 'data', 'ip_country.csv')
+GEOIP_REFRESH = int(os.environ.get('GEOIP_REFRESH', 300))
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', 4096))
+GEOIP_TRUST_PROXY = os.environ.get('GEOIP_TRUST_PROXY', '') == '1'
+GEOIP_SOURCE_URL = 'https://download.db-ip.com/free/dbip-country-lite-{month}.csv.gz'
+# pages carry this marker where the server injects the visitor's region
+GEO_MARKER = '<!--fynelis:geo-->'
+
+# 'I' is 4 bytes on every mainstream platform; fall back to 'L' where it isn't
+_V4_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+_MASK64 = (1 << 64) - 1
+
+
+class RangeTable:
+    """Sorted, non-overlapping IPv4 ranges."""
+
+    def __init__(self):
+        self.starts = array(_V4_TYPECODE)
+        self.ends = array(_V4_TYPECODE)
+        self.codes = array('H')
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, start, end, code):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.codes.append(code)
+
+    def lookup(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.codes[i]
+        return None
+
+
+class WideRangeTable(RangeTable):
+    """RangeTable for 128-bit IPv6 values, each stored as two unsigned 64-bit halves."""
+
+    def __init__(self):
+        self.starts_hi = array('Q')
+        self.starts_lo = array('Q')
+        self.ends_hi = array('Q')
+        self.ends_lo = array('Q')
+        self.codes = array('H')
+
+    def append(self, start, end, code):
+        self.starts_hi.append(start >> 64)
+        self.starts_lo.append(start & _MASK64)
+        self.ends_hi.append(end >> 64)
+        self.ends_lo.append(end & _MASK64)
+        self.codes.append(code)
+
+    def lookup(self, value):
+        hi, lo = value >> 64, value & _MASK64
+        # starts are sorted by (hi, lo): narrow to the run sharing `hi`, then bisect its low halves
+        first = bisect.bisect_left(self.starts_hi, hi)
+        last = bisect.bisect_right(self.starts_hi, hi, first)
+        i = bisect.bisect_right(self.starts_lo, lo, first, last) - 1
+        if i >= 0 and (hi, lo) <= (self.ends_hi[i], self.ends_lo[i]):
+            return self.codes[i]
+        return None
+
+
+class GeoSnapshot:
+    """One loaded database. Never modified after loading, so a reload swaps a single reference."""
+
+    def __init__(self, countries=(), v4=None, v6=None):
+        self.countries = tuple(countries)
+        self.v4 = v4 if v4 is not None else RangeTable()
+        self.v6 = v6 if v6 is not None else WideRangeTable()
+        # the cache belongs to the snapshot, so a reload can never mix old and new entries
+        self.lookup = lru_cache(maxsize=GEOIP_CACHE_SIZE)(self._lookup)
+
+    def _lookup(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        table = self.v4 if addr.version == 4 else self.v6
+        code = table.lookup(int(addr))
+        return self.countries[code] if code is not None else None
+
+
+COMPILED_MAGIC = b'FYNELIS-GEOIP-1\n'
+
+
+def parse_csv(path):
+    """Parse the range CSV into a GeoSnapshot (slow: seconds for a full DB-IP file)."""
+    rows = {4: [], 6: []}
+    country_index = {}
+    countries = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            try:
+                start = ipaddress.ip_address(row[0].strip())
+                end = ipaddress.ip_address(row[1].strip())
+            except ValueError:
+                continue  # header line or junk
+            code = row[2].strip().upper()
+            if code not in country_index:
+                country_index[code] = len(countries)
+                countries.append(code)
+            rows[start.version].append((int(start), int(end), country_index[code]))
+    v4 = RangeTable()
+    v6 = WideRangeTable()
+    for table, items in ((v4, rows[4]), (v6, rows[6])):
+        items.sort()
+        for start, end, code in items:
+            table.append(start, end, code)
+    return GeoSnapshot(countries, v4, v6)
+
+
+def _compiled_arrays(snapshot):
+    v4, v6 = snapshot.v4, snapshot.v6
+    return [v4.starts, v4.ends, v4.codes, v6.starts_hi, v6.starts_lo, v6.ends_hi, v6.ends_lo, v6.codes]
+
+
+def write_compiled(snapshot, dest, source_mtime):
+    """Dump the parsed arrays next to the CSV so later loads skip parsing."""
+    arrays = _compiled_arrays(snapshot)
+    header = {
+        'source_mtime': source_mtime,
+        'byteorder': sys.byteorder,
+        'countries': list(snapshot.countries),
+        'arrays': [[a.typecode, a.itemsize, len(a)] for a in arrays],
+    }
+    tmp = dest + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(COMPILED_MAGIC)
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for a in arrays:
+            a.tofile(f)
+    os.replace(tmp, dest)
+
+
+def read_compiled(path, source_mtime):
+    """Load a dump from write_compiled(), or None if it is missing, stale or from another platform."""
+    snapshot = GeoSnapshot()
+    arrays = _compiled_arrays(snapshot)
+    try:
+        with open(path, 'rb') as f:
+            if f.readline() != COMPILED_MAGIC:
+                return None
+            header = json.loads(f.readline().decode('utf-8'))
+            if header['source_mtime'] != source_mtime or header['byteorder'] != sys.byteorder:
+                return None
+            if [[a.typecode, a.itemsize] for a in arrays] != [spec[:2] for spec in header['arrays']]:
+                return None
+            for a, (_, _, count) in zip(arrays, header['arrays']):
+                a.fromfile(f, count)
+    except (OSError, ValueError, KeyError, EOFError):
+        return None
+    return GeoSnapshot(header['countries'], snapshot.v4, snapshot.v6)
+
+
+def compiled_path(path):
+    return path + '.bin'
+
+
+class GeoIPDatabase:
+    """The current GeoSnapshot plus its reloading.
+
+    Reloads run on a background thread; lookups keep using the previous snapshot until the
+    new one is swapped in, so the request path never parses the CSV.
+    """
+
+    def __init__(self, path=GEOIP_DB):
+        self.path = path
+        self.snapshot = GeoSnapshot()
+        self.mtime = None
+        self.checked = 0
+        self.loading = False
+        self.lock = threading.Lock()
+
+    def load(self, mtime):
+        compiled = compiled_path(self.path)
+        snapshot = read_compiled(compiled, mtime)
+        if snapshot is None:
+            snapshot = parse_csv(self.path)
+            try:
+                # one worker pays for the parse; the rest (and the next restart) read the dump
+                write_compiled(snapshot, compiled, mtime)
+            except OSError:
+                pass
+        # a single attribute assignment: lookups see either the old or the new snapshot
+        self.snapshot = snapshot
+        self.mtime = mtime
+
+    def _load_in_background(self, mtime):
+        try:
+            self.load(mtime)
+        except Exception:
+            # keep serving the previous snapshot; retried at the next GEOIP_REFRESH check
+            pass
+        finally:
+            self.loading = False
+
+    def refresh(self, force=False, wait=False):
+        """Pick up a new or changed file, checked at most every GEOIP_REFRESH seconds.
+
+        With wait=True (startup, CLI) the load happens inline; otherwise it is started on a
+        background thread and this returns immediately.
+        """
+        now = time.time()
+        if not force and now - self.checked < GEOIP_REFRESH:
+            return
+        with self.lock:
+            if self.loading or (not force and now - self.checked < GEOIP_REFRESH):
+                return
+            self.checked = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if not force and mtime == self.mtime:
+                return
+            if wait:
+                self.load(mtime)
+                return
+            self.loading = True
+        threading.Thread(target=self._load_in_background, args=(mtime,), name='geoip-reload', daemon=True).start()
+
+    def lookup(self, ip):
+        """Return the ISO country code for `ip`, or None if unknown."""
+        self.refresh()
+        snapshot = self.snapshot
+        if not snapshot.countries:
+            return None
+        return snapshot.lookup(ip)
+
+
+geo_db = GeoIPDatabase()
+
+
+def client_ip(request):
+    # only honour X-Forwarded-For when a trusted reverse proxy sets it
+    if GEOIP_TRUST_PROXY:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr
+
+
+def lookup_country(request):
+    ip = client_ip(request)
+    return geo_db.lookup(ip) if ip else None
+
+
+def inject_geo(html, country):
+    script = '<script>window.FYNELLIS_GEO = %s;</script>' % json.dumps({'country': country}).replace('<', '\\u003c')
+    return html.replace(GEO_MARKER, script, 1)
+
+
+def fetch(dest=GEOIP_DB, url=None):
+    """Download the DB-IP country lite CSV and atomically replace `dest`."""
+    url = url or GEOIP_SOURCE_URL.format(month=datetime.utcnow().strftime('%Y-%m'))
+    with urllib.request.urlopen(url, timeout=60) as resp:
+        data = resp.read()
+    if url.endswith('.gz'):
+        data = gzip.decompress(data)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, dest)
+    # compile now so servers load the arrays in milliseconds instead of parsing the CSV
+    write_compiled(parse_csv(dest), compiled_path(dest), os.path.getmtime(dest))
+    return dest
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'fetch':
+        print('Saved', fetch(url=sys.argv[2] if len(sys.argv) > 2 else None))
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'lookup':
+        started = time.perf_counter()
+        geo_db.refresh(force=True, wait=True)
+        print('Loaded %d IPv4 / %d IPv6 ranges in %.2fs' % (len(geo_db.snapshot.v4), len(geo_db.snapshot.v6), time.perf_counter() - started))
+        for ip in sys.argv[2:]:
+            print(ip, geo_db.lookup(ip))
+    else:
+        print(__doc__)
@@ -0,0 +1,189 @@
+"""In-memory page serving with locale negotiation.
+
+Prerendered variants come from build_locales.py (dist/<locale>/<page>). A variant is
+chosen per request from, in order: the site_lang cookie, Accept-Language, the visitor's
+country (geoip.py), then the default locale. Without a build, pages are served from
+the source tree. Either way the HTML is read once and kept in memory. The cache is
+dropped when dist/build.json changes or a source file's mtime changes. The build writes
+build.json after its last stage, so pages read while a build is still rewriting dist/
+are discarded once it finishes. A dist/ without build.json is not served.
+"""
+import os
+import json
+import mimetypes
+import threading
+
+from flask import abort, send_from_directory
+
+from geoip import GEO_MARKER, inject_geo, lookup_country
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.environ.get('BUILD_DIR') or os.path.join(APP_ROOT, 'dist')
+LOCALE_COOKIE = 'site_lang'
+LOCALE_MANIFEST = 'locales.json'
+BUILD_STAMP = 'build.json'
+PRELOAD_MANIFEST = 'preload.json'
+SERVICE_WORKER = 'sw.js'
+# country -> locale for visitors without a cookie or a usable Accept-Language
+COUNTRY_LOCALES = {'FR': 'fr'}
+
+
+def parse_accept_language(header):
+    """Return primary language subtags from an Accept-Language header, best first."""
+    langs = []
+    for i, part in enumerate((header or '').split(',')):
+        bits = part.strip().split(';')
+        tag = bits[0].strip().lower()
+        if not tag or tag == '*':
+            continue
+        q = 1.0
+        for param in bits[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            langs.append((-q, i, tag.split('-')[0]))
+    return [lang for _, _, lang in sorted(langs)]
+
+
+class PageStore:
+    def __init__(self, source_dir=APP_ROOT, build_dir=BUILD_DIR):
+        self.source_dir = source_dir
+        self.build_dir = build_dir
+        self.manifest = None
+        self.stamp_mtime = None
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def _check_manifest(self):
+        try:
+            mtime = os.stat(os.path.join(self.build_dir, BUILD_STAMP)).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.stamp_mtime:
+            return self.manifest
+        with self.lock:
+            manifest = None
+            if mtime is not None:
+                with open(os.path.join(self.build_dir, LOCALE_MANIFEST), 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            self.manifest, self.stamp_mtime = manifest, mtime
+            self.pages = {}
+        return manifest
+
+    def negotiate(self, request, name):
+        """Pick the locale to serve `name` in, or None when it has no variants."""
+        manifest = self._check_manifest()
+        if not manifest or name not in manifest.get('pages', []):
+            return None
+        locales = manifest.get('locales', [])
+        cookie = (request.cookies.get(LOCALE_COOKIE) or '').lower()
+        if cookie in locales:
+            return cookie
+        for lang in parse_accept_language(request.headers.get('Accept-Language')):
+            if lang in locales:
+                return lang
+        country_locale = COUNTRY_LOCALES.get(lookup_country(request) or '')
+        if country_locale in locales:
+            return country_locale
+        return manifest.get('default') or locales[0]
+
+    def get(self, name, locale=None):
+        self._check_manifest()
+        stamp = self.stamp_mtime
+        path = os.path.join(self.build_dir, locale, name) if locale else os.path.join(self.source_dir, name)
+        if locale:
+            # built variants only change with the build stamp, so no per-request stat
+            hit = self.pages.get((name, locale))
+            if hit:
+                return hit[1]
+            mtime = None
+        else:
+            mtime = os.path.getmtime(path)
+            hit = self.pages.get((name, None))
+            if hit and hit[0] == mtime:
+                return hit[1]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                html = f.read()
+        except FileNotFoundError:
+            if locale:
+                return self.get(name)
+            raise
+        with self.lock:
+            # a build finished while we were reading: don't cache what may be a half-built file
+            if self.stamp_mtime == stamp:
+                self.pages[(name, locale)] = (mtime, html)
+        return html
+
+
+class PreloadHints:
+    """Per-page `Link` headers from dist/preload.json (build_preload.py), rebuilt when it changes."""
+
+    def __init__(self, build_dir=BUILD_DIR):
+        self.path = os.path.join(build_dir, PRELOAD_MANIFEST)
+        self.mtime = None
+        self.headers = {}
+
+    def link_header(self, name):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            headers = {}
+            if mtime is not None:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    graph = json.load(f)
+                headers = dict((page, ', '.join(entry['links'])) for page, entry in graph.items() if entry.get('links'))
+            self.headers, self.mtime = headers, mtime
+        return self.headers.get(name)
+
+
+page_store = PageStore()
+preload_hints = PreloadHints()
+
+
+def serve_page(app, request, name):
+    locale = page_store.negotiate(request, name)
+    html = page_store.get(name, locale)
+    if GEO_MARKER in html:
+        html = inject_geo(html, lookup_country(request))
+    resp = app.response_class(html, mimetype='text/html')
+    # a CDN or proxy that supports it (e.g. nginx early_hints, Cloudflare) can replay
+    # these as 103 Early Hints; WSGI itself cannot send informational responses
+    link = preload_hints.link_header(name)
+    if link:
+        resp.headers['Link'] = link
+    if locale:
+        resp.headers['Content-Language'] = locale
+        resp.vary.update(('Accept-Language', 'Cookie'))
+    # the body depends on per-client headers
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def serve_build_asset(app, request, subdir, filename):
+    """Serve a content-hashed build output (e.g. dist/css/*.css) with long-lived caching."""
+    directory = os.path.join(BUILD_DIR, subdir)
+    gz = request.accept_encodings['gzip'] > 0 and os.path.exists(os.path.join(directory, filename + '.gz'))
+    resp = send_from_directory(directory, filename + '.gz' if gz else filename,
+                               mimetype=mimetypes.guess_type(filename)[0], max_age=31536000)
+    if gz:
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def serve_service_worker(app):
+    """Serve dist/sw.js (build_sw.py); it must come from the site root to control every page."""
+    if not os.path.exists(os.path.join(BUILD_DIR, SERVICE_WORKER)):
+        abort(404)
+    resp = send_from_directory(BUILD_DIR, SERVICE_WORKER, mimetype='application/javascript')
+    # browsers check for a new worker on navigation; never let a stale copy delay a deploy
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
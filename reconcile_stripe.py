@@ -0,0 +1,245 @@
+"""Reconcile User.subscription (server_pg.py) with Stripe.
+
+Usage:
+    python reconcile_stripe.py [--pages N] [--restart] [--dry-run]
+
+Subscription state normally only changes when /webhook delivers an event, so a missed or
+failed webhook leaves a stale entitlement. This pages through Stripe customers
+(RECONCILE_PAGE_SIZE per page) and matches each page against local users in one query.
+It then fetches the matched customers' subscriptions on a pool of RECONCILE_WORKERS
+threads, with every Stripe call going through a shared RECONCILE_RATE requests/second
+limit. Each user's subscription_id and status are compared with the one Stripe would
+bill. The read replica, if configured, only picks the candidates. Corrections are
+written RECONCILE_BATCH users per transaction: each row is re-read from the primary
+and the correction is recomputed from it, and the user's ETag version is bumped.
+
+The cursor (the last customer id of the last finished page) is saved to RECONCILE_CURSOR
+after each page, so `--pages N` from cron works through the account in slices and a
+crashed run resumes where it stopped. A finished pass clears the cursor.
+
+Needs STRIPE_SECRET_KEY. Set STRIPE_API_BASE to run against a local stand-in, e.g.
+stripe-mock (`STRIPE_API_BASE=http://localhost:12111 STRIPE_SECRET_KEY=sk_test_123`).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from server_pg import STRIPE_AVAILABLE, ReplicaSession, SessionLocal, User, bump_user_version, stripe
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+RECONCILE_CURSOR = os.environ.get('RECONCILE_CURSOR') or os.path.join(APP_ROOT, 'data', 'stripe_reconcile.json')
+RECONCILE_WORKERS = int(os.environ.get('RECONCILE_WORKERS', 8))
+# Stripe allows 100 req/s live and 25 req/s in test mode; stay well under either
+RECONCILE_RATE = float(os.environ.get('RECONCILE_RATE', 20))
+RECONCILE_BATCH = int(os.environ.get('RECONCILE_BATCH', 100))
+RECONCILE_PAGE_SIZE = min(int(os.environ.get('RECONCILE_PAGE_SIZE', 100)), 100)
+# statuses that still entitle the customer, preferred over ended subscriptions
+LIVE_STATUSES = ('active', 'trialing', 'past_due', 'unpaid', 'incomplete')
+
+
+class RateLimiter:
+    """Token bucket shared by the worker threads; burst=1 spaces calls evenly."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_cursor(path=RECONCILE_CURSOR):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_cursor(state, path=RECONCILE_CURSOR):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def current_subscription(subs):
+    """The subscription that decides the customer's entitlement, or None."""
+    if not subs:
+        return None
+    live = [s for s in subs if s['status'] in LIVE_STATUSES]
+    return max(live or subs, key=lambda s: s['created'])
+
+
+def desired_state(local, sub):
+    """Return the corrected subscription dict for a user, or None when `local` already matches."""
+    if sub is None:
+        # nothing in Stripe: only touch subscriptions that came from Stripe in the first place
+        if not local or not local.get('subscription_id') or local.get('status') == 'canceled':
+            return None
+        return dict(local, status='canceled', updated=datetime.utcnow().isoformat())
+    if local and local.get('subscription_id') == sub['id'] and local.get('status') == sub['status']:
+        return None
+    # keep fields the webhook maintains (e.g. last_invoice)
+    return dict(local or {}, subscription_id=sub['id'], status=sub['status'], updated=datetime.utcnow().isoformat())
+
+
+class Reconciler:
+    def __init__(self, workers=RECONCILE_WORKERS, rate=RECONCILE_RATE, batch=RECONCILE_BATCH, dry_run=False):
+        self.limiter = RateLimiter(rate)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.batch = batch
+        self.dry_run = dry_run
+        self.pending = {}
+        self.stats = {'pages': 0, 'customers': 0, 'matched': 0, 'calls': 0, 'corrected': 0}
+        self.stats_lock = threading.Lock()
+
+    def call(self, fn, **params):
+        self.limiter.acquire()
+        with self.stats_lock:
+            self.stats['calls'] += 1
+        return fn(**params)
+
+    def fetch_subscriptions(self, customer):
+        subs = []
+        params = {'customer': customer, 'status': 'all', 'limit': 100}
+        while True:
+            page = self.call(stripe.Subscription.list, **params)
+            subs.extend(page['data'])
+            if not page['has_more'] or not page['data']:
+                return subs
+            params['starting_after'] = page['data'][-1]['id']
+
+    def local_users(self, customer_ids):
+        # only picks candidates, so a lagging replica is fine here; flush() re-reads the primary
+        db = ReplicaSession()
+        try:
+            rows = db.query(User.id, User.stripe_customer_id, User.subscription).filter(
+                User.stripe_customer_id.in_(customer_ids)).all()
+        finally:
+            db.close()
+        return dict((cid, (uid, json.loads(sub) if sub else None)) for uid, cid, sub in rows)
+
+    def reconcile_page(self, customers):
+        users = self.local_users([c['id'] for c in customers])
+        futures = dict((cid, self.pool.submit(self.fetch_subscriptions, cid)) for cid in users)
+        for cid, fut in futures.items():
+            user_id, local = users[cid]
+            sub = current_subscription(fut.result())
+            fixed = desired_state(local, sub)
+            if fixed is not None:
+                if self.dry_run:
+                    before = local or {}
+                    print('  user %d (%s): %s/%s -> %s/%s' % (user_id, cid, before.get('subscription_id'), before.get('status'),
+                                                             fixed['subscription_id'], fixed['status']))
+                # keep Stripe's side only; the correction is recomputed against the primary row
+                self.pending[user_id] = sub
+        self.stats['customers'] += len(customers)
+        self.stats['matched'] += len(users)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.dry_run:
+            self.stats['corrected'] += len(self.pending)
+            self.pending = {}
+            return
+        db = SessionLocal()
+        try:
+            # lock the rows so a webhook can't commit between this read and the write
+            users = db.query(User).filter(User.id.in_(list(self.pending))).with_for_update().all()
+            for user in users:
+                local = json.loads(user.subscription) if user.subscription else None
+                fixed = desired_state(local, self.pending[user.id])
+                if fixed is None:
+                    continue  # already fixed on the primary (e.g. by a webhook)
+                user.subscription = json.dumps(fixed)
+                db.add(user)
+                bump_user_version(db, user.id)
+                self.stats['corrected'] += 1
+            db.commit()
+        finally:
+            db.close()
+        self.pending = {}
+
+    def run(self, max_pages=None, restart=False):
+        state = {} if restart else load_cursor()
+        started = time.perf_counter()
+        params = {'limit': RECONCILE_PAGE_SIZE}
+        if state.get('starting_after'):
+            params['starting_after'] = state['starting_after']
+            print('Resuming after %s' % state['starting_after'])
+        finished = False
+        try:
+            while max_pages is None or self.stats['pages'] < max_pages:
+                page = self.call(stripe.Customer.list, **params)
+                customers = page['data']
+                if customers:
+                    self.reconcile_page(customers)
+                self.stats['pages'] += 1
+                if not page['has_more'] or not customers:
+                    finished = True
+                    break
+                params['starting_after'] = customers[-1]['id']
+                # corrections before the cursor must be on disk before the cursor moves past them
+                self.flush()
+                if not self.dry_run:
+                    save_cursor({'starting_after': params['starting_after'], 'updated': datetime.utcnow().isoformat()})
+            self.flush()
+            if finished and not self.dry_run:
+                save_cursor({'completed': datetime.utcnow().isoformat()})
+        finally:
+            self.pool.shutdown(wait=True)
+        self.report(time.perf_counter() - started, finished)
+        return self.stats
+
+    def report(self, elapsed, finished):
+        s = self.stats
+        rate = lambda n: n / elapsed if elapsed > 0 else 0.0
+        print('%s: %d pages, %d customers (%d local), %d corrections%s' % (
+            'Finished pass' if finished else 'Stopped', s['pages'], s['customers'], s['matched'],
+            s['corrected'], ' (dry run, nothing written)' if self.dry_run else ''))
+        print('%.1fs elapsed, %.1f customers/s, %.1f Stripe calls/s (limit %.0f/s)' % (
+            elapsed, rate(s['customers']), rate(s['calls']), self.limiter.rate))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reconcile local subscriptions with Stripe.')
+    parser.add_argument('--pages', type=int, help='stop after this many customer pages (resume on the next run)')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved cursor and start a new pass')
+    parser.add_argument('--dry-run', action='store_true', help='print corrections without writing them')
+    args = parser.parse_args(argv)
+    if not STRIPE_AVAILABLE or not os.environ.get('STRIPE_SECRET_KEY'):
+        print('Stripe not configured. Install stripe and set STRIPE_SECRET_KEY.')
+        return 1
+    stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+    if os.environ.get('STRIPE_API_BASE'):
+        stripe.api_base = os.environ['STRIPE_API_BASE']
+    # let the client back off on 429s instead of failing the page
+    stripe.max_network_retries = 3
+    Reconciler(dry_run=args.dry_run).run(max_pages=args.pages, restart=args.restart)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
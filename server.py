@@ -1,11 +1,17 @@
 import os
 import json
 import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
 from flask import Flask, request, jsonify, send_from_directory, abort
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from compression import init_compression
+from geoip import geo_db, lookup_country
+from pages import serve_build_asset, serve_page, serve_service_worker
+
 # Optional: stripe if configured
 try:
     import stripe
@@ -33,6 +39,34 @@ def save_db(db):
         json.dump(db, f, indent=2, default=str)
 
 app = Flask(__name__, static_folder=APP_ROOT, static_url_path='')
+init_compression(app)
+# load the GeoIP table now rather than on the first request (changes reload in the background)
+geo_db.refresh(wait=True)
+
+# Per-user version counter and weak ETags
+def bump_user_version(u):
+    # bumped whenever locally stored data served by /api/profile or /api/dashboard changes
+    u['version'] = u.get('version', 0) + 1
+
+def user_etag(u, scope):
+    uid = hashlib.sha1(u['email'].encode('utf-8')).hexdigest()[:12]
+    return '%s-%s-%d' % (scope, uid, u.get('version', 0))
+
+def payload_etag(u, scope, payload):
+    # for data fetched from Stripe, which never bumps the counter: hash what is actually sent
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return '%s-%s' % (user_etag(u, scope), digest)
+
+def not_modified(etag):
+    resp = app.response_class(status=304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+def with_etag(resp, etag):
+    resp.set_etag(etag, weak=True)
+    # let clients keep the body but revalidate every time
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
 # Helper: token-based auth (simple)
 def require_auth(fn):
@@ -51,6 +85,8 @@ def require_auth(fn):
                     return jsonify({'error': 'Unauthorized'}), 401
                 if expires > datetime.utcnow():
                     request.user_email = sess.get('email')
+                    # keep the loaded db around so handlers can skip a second read
+                    request.db = db
                     return fn(*args, **kwargs)
                 # expired: remove it
                 sessions.pop(token, None)
@@ -59,9 +95,32 @@ def require_auth(fn):
     return wrapper
 
 # Serve static files (HTML/CSS/JS)
+# Site pages: prerendered per-locale variants when built (see build_locales.py / pages.py)
 @app.route('/')
 def index():
-    return send_from_directory(APP_ROOT, 'index.html')
+    return serve_page(app, request, 'index.html')
+
+@app.route('/index.html')
+@app.route('/legal.html')
+@app.route('/privacy.html')
+@app.route('/terms.html')
+@app.route('/login.html')
+@app.route('/signup.html')
+@app.route('/dashboard.html')
+def site_page():
+    return serve_page(app, request, request.path.lstrip('/'))
+
+@app.route('/css/build/<path:filename>')
+def built_css(filename):
+    return serve_build_asset(app, request, 'css', filename)
+
+@app.route('/sw.js')
+def service_worker():
+    return serve_service_worker(app)
+
+@app.route('/api/geo', methods=['GET'])
+def api_geo():
+    return jsonify({'country': lookup_country(request)})
 
 @app.route('/<path:filename>')
 def static_files(filename):
@@ -140,18 +199,39 @@ def api_login():
     save_db(db)
     return jsonify({'ok': True, 'token': token, 'email': email})
 
+# Payload builders shared by the single-purpose endpoints and /api/dashboard
+def _profile_payload(u):
+    # return safe profile fields
+    return {k: v for k, v in u.items() if k not in ('password_hash', 'version')}
+
+def _subscription_payload(u):
+    sub = u.get('subscription')
+    if sub:
+        status = sub.get('status') or 'unknown'
+    elif u.get('trial_expires') and datetime.fromisoformat(u['trial_expires']) > datetime.utcnow():
+        status = 'trial'
+    else:
+        status = 'none'
+    return {'status': status, 'subscription': sub}
+
+def _fetch_invoices(customer):
+    invoices = stripe.Invoice.list(customer=customer)
+    res = []
+    for inv in invoices.auto_paging_iter():
+        res.append({'id': inv.id, 'amount_due': inv.amount_due, 'status': inv.status, 'pdf': inv.invoice_pdf})
+    return res
+
 # Profile GET/POST
 @app.route('/api/profile', methods=['GET'])
 @require_auth
 def api_profile_get():
-    db = load_db()
-    users = db.get('users', {})
-    u = users.get(request.user_email)
+    u = request.db.get('users', {}).get(request.user_email)
     if not u:
         return jsonify({'error': 'not found'}), 404
-    # return safe profile fields
-    payload = {k: v for k, v in u.items() if k not in ('password_hash',)}
-    return jsonify({'ok': True, 'profile': payload})
+    etag = user_etag(u, 'profile')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    return with_etag(jsonify({'ok': True, 'profile': _profile_payload(u)}), etag)
 
 @app.route('/api/profile', methods=['POST'])
 @require_auth
@@ -169,6 +249,7 @@ def api_profile_update():
             profile[field] = data[field]
     if 'password' in data and data['password']:
         u['password_hash'] = generate_password_hash(data['password'])
+    bump_user_version(u)
     save_db(db)
     return jsonify({'ok': True})
 
@@ -237,6 +318,7 @@ def api_create_portal():
         cust = stripe.Customer.create(email=user['email'])
         customer = cust['id']
         user['stripe_customer_id'] = customer
+        bump_user_version(user)
         save_db(db)
 
     session = stripe.billing_portal.Session.create(customer=customer, return_url=request.json.get('return_url') or request.host_url)
@@ -249,19 +331,69 @@ def api_invoices():
     if not STRIPE_AVAILABLE or not os.environ.get('STRIPE_SECRET_KEY'):
         return jsonify({'error': 'Stripe not configured on server. Return mock data or set STRIPE_SECRET_KEY.'}), 501
     stripe.api_key = os.environ['STRIPE_SECRET_KEY']
-    db = load_db()
-    user = db['users'].get(request.user_email)
+    user = request.db['users'].get(request.user_email)
     if not user:
         return jsonify({'error': 'user not found'}), 404
     customer = user.get('stripe_customer_id')
-    if not customer:
-        return jsonify({'invoices': []})
-    invoices = stripe.Invoice.list(customer=customer)
     # return minimal invoice info
-    res = []
-    for inv in invoices.auto_paging_iter():
-        res.append({'id': inv.id, 'amount_due': inv.amount_due, 'status': inv.status, 'pdf': inv.invoice_pdf})
-    return jsonify({'invoices': res})
+    invoices = _fetch_invoices(customer) if customer else []
+    etag = payload_etag(user, 'invoices', invoices)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    return with_etag(jsonify({'invoices': invoices}), etag)
+
+# Dashboard: one authenticated round trip for any subset of the dashboard sections.
+# dashboard.html asks for profile+subscription first and invoices only on demand.
+# Remote fetches (Stripe) run on a small shared pool while local sections are built.
+DASHBOARD_FIELDS = ('profile', 'subscription', 'invoices')
+DASHBOARD_FETCH_TIMEOUT = float(os.environ.get('DASHBOARD_FETCH_TIMEOUT', 10))
+dashboard_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('DASHBOARD_WORKERS', 4)))
+
+@app.route('/api/dashboard', methods=['GET'])
+@require_auth
+def api_dashboard():
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    # a missing or empty ?fields= (e.g. "?fields=,") means every section
+    fields = fields or list(DASHBOARD_FIELDS)
+    unknown = [f for f in fields if f not in DASHBOARD_FIELDS]
+    if unknown:
+        return jsonify({'error': 'unknown fields: ' + ','.join(unknown)}), 400
+    user = request.db.get('users', {}).get(request.user_email)
+    if not user:
+        return jsonify({'error': 'not found'}), 404
+    res = {'ok': True}
+    errors = {}
+    pending = {}
+    etag = user_etag(user, 'dashboard-' + '.'.join(fields))
+    if 'subscription' in fields:
+        res['subscription'] = _subscription_payload(user)
+        # a trial expires with the clock, not with a change to the stored data
+        etag += '-' + res['subscription']['status']
+    if 'invoices' not in fields and request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    if 'invoices' in fields:
+        if not STRIPE_AVAILABLE or not os.environ.get('STRIPE_SECRET_KEY'):
+            errors['invoices'] = 'Stripe not configured on server.'
+        elif not user.get('stripe_customer_id'):
+            res['invoices'] = []
+        else:
+            stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+            pending['invoices'] = dashboard_pool.submit(_fetch_invoices, user['stripe_customer_id'])
+    if 'profile' in fields:
+        res['profile'] = _profile_payload(user)
+    for name, fut in pending.items():
+        try:
+            res[name] = fut.result(timeout=DASHBOARD_FETCH_TIMEOUT)
+        except Exception:
+            errors[name] = 'Failed to fetch ' + name
+    if errors:
+        res['errors'] = errors
+        return jsonify(res)
+    if 'invoices' in fields:
+        etag = payload_etag(user, 'dashboard-' + '.'.join(fields), res)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+    return with_etag(jsonify(res), etag)
 
 # Create subscription / checkout session (simplified stub)
 @app.route('/api/subscribe', methods=['POST'])
@@ -273,6 +405,7 @@ def api_subscribe():
         db = load_db()
         user = db['users'].get(request.user_email)
         user['subscription'] = {'plan': plan, 'status': 'active', 'started': datetime.utcnow().isoformat()}
+        bump_user_version(user)
         save_db(db)
         return jsonify({'ok': True, 'subscription': user['subscription']})
     # Minimal real Stripe Checkout flow (requires configured products/prices)
@@ -285,6 +418,7 @@ def api_subscribe():
     if not user.get('stripe_customer_id'):
         cust = stripe.Customer.create(email=user['email'])
         user['stripe_customer_id'] = cust['id']
+        bump_user_version(user)
         save_db(db)
     # In a real integration you'd create a Checkout Session with a price id
     return jsonify({'error': 'Real Stripe Checkout not configured. Provide PRICE_ID and STRIPE_SECRET_KEY.'}), 501
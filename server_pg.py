@@ -1,14 +1,19 @@
 import os
 import json
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, request, jsonify, send_from_directory, abort, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from sqlalchemy import (create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Boolean)
+from sqlalchemy import (create_engine, event, Column, Integer, String, DateTime, Text, ForeignKey, Boolean)
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 
+from compression import init_compression
+from geoip import geo_db, lookup_country
+from pages import serve_build_asset, serve_page, serve_service_worker
+
 # Optional: stripe if configured
 try:
     import stripe
@@ -24,6 +29,35 @@ if not DATABASE_URL:
 
 engine = create_engine(DATABASE_URL, echo=False, future=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# Optional read replica for read-only work (token checks, profile reads, webhook lookups).
+# A client that just wrote is pinned to the primary for REPLICA_PIN_SECONDS so it reads
+# its own writes; without DATABASE_REPLICA_URL everything uses the primary.
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_PIN_COOKIE = 'db_primary'
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine(DATABASE_REPLICA_URL, echo=False, future=True)
+    ReplicaSession = sessionmaker(bind=replica_engine, autoflush=False, autocommit=False)
+
+    @event.listens_for(ReplicaSession, 'before_flush')
+    def _replica_read_only(session, flush_context, instances):
+        raise RuntimeError('replica sessions are read-only; use SessionLocal for writes')
+else:
+    replica_engine = engine
+    ReplicaSession = SessionLocal
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _pin_to_primary(session):
+    # every commit on the primary is a write; later reads in this request and from this client follow it
+    if has_request_context():
+        g.db_pinned = True
+
+def read_session():
+    # Session for read-only work: the replica unless this client wrote recently
+    if replica_engine is engine or g.get('db_pinned') or request.cookies.get(REPLICA_PIN_COOKIE):
+        return SessionLocal()
+    return ReplicaSession()
 Base = declarative_base()
 
 class User(Base):
@@ -56,10 +90,55 @@ class UsedPhone(Base):
     __tablename__ = 'used_phones'
     phone = Column(String(64), primary_key=True)
 
+class UserVersion(Base):
+    # bumped whenever data served by /api/profile or /api/invoices changes; drives their ETags
+    __tablename__ = 'user_versions'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 # Create tables if not exist
 Base.metadata.create_all(bind=engine)
 
 app = Flask(__name__, static_folder=os.path.dirname(os.path.abspath(__file__)), static_url_path='')
+init_compression(app)
+# load the GeoIP table now rather than on the first request (changes reload in the background)
+geo_db.refresh(wait=True)
+
+@app.after_request
+def pin_primary_cookie(resp):
+    if replica_engine is not engine and g.get('db_pinned'):
+        resp.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+    return resp
+
+# Per-user version counter and weak ETags
+def bump_user_version(db, user_id):
+    # call before db.commit() so the bump lands in the same transaction as the change
+    updated = db.query(UserVersion).filter_by(user_id=user_id).update({UserVersion.version: UserVersion.version + 1})
+    if not updated:
+        db.add(UserVersion(user_id=user_id, version=1))
+
+def user_etag(db, user, scope):
+    row = db.query(UserVersion).get(user.id)
+    return '%s-%d-%d' % (scope, user.id, row.version if row else 0)
+
+def not_modified(etag):
+    resp = app.response_class(status=304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+def with_etag(resp, etag):
+    resp.set_etag(etag, weak=True)
+    # let clients keep the body but revalidate every time
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def _delete_session(token):
+    db = SessionLocal()
+    try:
+        db.query(SessionToken).filter_by(token=token).delete()
+        db.commit()
+    finally:
+        db.close()
 
 # Auth decorator
 def require_auth(fn):
@@ -68,16 +147,21 @@ def require_auth(fn):
         auth = request.headers.get('Authorization', '')
         if auth.startswith('Bearer '):
             token = auth.split(' ', 1)[1]
-            db = SessionLocal()
+            db = read_session()
             try:
                 sess = db.query(SessionToken).filter_by(token=token).one_or_none()
+                if sess is None and db.get_bind() is not engine:
+                    # the token may be newer than the replica's copy
+                    db.close()
+                    db = SessionLocal()
+                    sess = db.query(SessionToken).filter_by(token=token).one_or_none()
                 if sess and sess.expires > datetime.utcnow():
                     request.user = db.query(User).get(sess.user_id)
+                    request.db = db
                     return fn(*args, **kwargs)
                 # expired -> remove
                 if sess:
-                    db.delete(sess)
-                    db.commit()
+                    _delete_session(token)
             finally:
                 db.close()
         return jsonify({'error': 'Unauthorized'}), 401
@@ -86,7 +170,30 @@ def require_auth(fn):
 # Serve static files
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'login.html')
+    return serve_page(app, request, 'login.html')
+
+# Site pages: prerendered per-locale variants when built (see build_locales.py / pages.py)
+@app.route('/index.html')
+@app.route('/legal.html')
+@app.route('/privacy.html')
+@app.route('/terms.html')
+@app.route('/login.html')
+@app.route('/signup.html')
+@app.route('/dashboard.html')
+def site_page():
+    return serve_page(app, request, request.path.lstrip('/'))
+
+@app.route('/css/build/<path:filename>')
+def built_css(filename):
+    return serve_build_asset(app, request, 'css', filename)
+
+@app.route('/sw.js')
+def service_worker():
+    return serve_service_worker(app)
+
+@app.route('/api/geo', methods=['GET'])
+def api_geo():
+    return jsonify({'country': lookup_country(request)})
 
 @app.route('/<path:filename>')
 def static_files(filename):
@@ -158,20 +265,58 @@ def api_login():
     finally:
         db.close()
 
-# Profile
-@app.route('/api/profile', methods=['GET'])
-@require_auth
-def api_profile_get():
-    user = request.user
+# Payload builders shared by the single-purpose endpoints and /api/dashboard
+def _profile_payload(user):
     # safe fields
-    payload = {
+    return {
         'email': user.email,
         'phone': user.phone,
         'trial_expires': user.trial_expires.isoformat() if user.trial_expires else None,
         'stripe_customer_id': user.stripe_customer_id,
         'profile': json.loads(user.profile) if user.profile else {}
     }
-    return jsonify({'ok': True, 'profile': payload})
+
+def _subscription_payload(user):
+    sub = json.loads(user.subscription) if user.subscription else None
+    if sub:
+        status = sub.get('status') or 'unknown'
+    elif user.trial_expires and user.trial_expires > datetime.utcnow():
+        status = 'trial'
+    else:
+        status = 'none'
+    return {'status': status, 'subscription': sub}
+
+def _user_id_for_customer(customer):
+    # stripe_customer_id isn't indexed, so scan the replica; fall back to the primary
+    # for a customer created moments ago that hasn't replicated yet
+    if not customer:
+        return None
+    factories = (ReplicaSession, SessionLocal) if replica_engine is not engine else (SessionLocal,)
+    for make_session in factories:
+        db = make_session()
+        try:
+            row = db.query(User.id).filter_by(stripe_customer_id=customer).first()
+        finally:
+            db.close()
+        if row:
+            return row[0]
+    return None
+
+def _fetch_invoices(customer):
+    invoices = stripe.Invoice.list(customer=customer)
+    res = []
+    for inv in invoices.auto_paging_iter():
+        res.append({'id': inv.id, 'amount_due': inv.amount_due, 'status': inv.status, 'pdf': inv.invoice_pdf})
+    return res
+
+# Profile
+@app.route('/api/profile', methods=['GET'])
+@require_auth
+def api_profile_get():
+    etag = user_etag(request.db, request.user, 'profile')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    return with_etag(jsonify({'ok': True, 'profile': _profile_payload(request.user)}), etag)
 
 @app.route('/api/profile', methods=['POST'])
 @require_auth
@@ -188,6 +333,7 @@ def api_profile_update():
             user.password_hash = generate_password_hash(data['password'])
         user.profile = json.dumps(profile)
         db.add(user)
+        bump_user_version(db, user.id)
         db.commit()
         return jsonify({'ok': True})
     finally:
@@ -259,6 +405,7 @@ def api_create_portal():
             cust = stripe.Customer.create(email=user.email)
             user.stripe_customer_id = cust['id']
             db.add(user)
+            bump_user_version(db, user.id)
             db.commit()
             customer = user.stripe_customer_id
         session = stripe.billing_portal.Session.create(customer=customer, return_url=request.json.get('return_url') or request.host_url)
@@ -272,6 +419,9 @@ def api_invoices():
     if not STRIPE_AVAILABLE or not os.environ.get('STRIPE_SECRET_KEY'):
         return jsonify({'error': 'Stripe not configured on server. Return mock data or set STRIPE_SECRET_KEY.'}), 501
     stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+    etag = user_etag(request.db, request.user, 'invoices')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
     db = SessionLocal()
     try:
         user = db.query(User).get(request.user.id)
@@ -279,15 +429,58 @@ def api_invoices():
             return jsonify({'error': 'user not found'}), 404
         customer = user.stripe_customer_id
         if not customer:
-            return jsonify({'invoices': []})
-        invoices = stripe.Invoice.list(customer=customer)
-        res = []
-        for inv in invoices.auto_paging_iter():
-            res.append({'id': inv.id, 'amount_due': inv.amount_due, 'status': inv.status, 'pdf': inv.invoice_pdf})
-        return jsonify({'invoices': res})
+            return with_etag(jsonify({'invoices': []}), etag)
+        return with_etag(jsonify({'invoices': _fetch_invoices(customer)}), etag)
     finally:
         db.close()
 
+# Dashboard: one authenticated round trip for any subset of the dashboard sections.
+# dashboard.html asks for profile+subscription first and invoices only on demand.
+# Remote fetches (Stripe) run on a small shared pool while local sections are built.
+DASHBOARD_FIELDS = ('profile', 'subscription', 'invoices')
+DASHBOARD_FETCH_TIMEOUT = float(os.environ.get('DASHBOARD_FETCH_TIMEOUT', 10))
+dashboard_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('DASHBOARD_WORKERS', 4)))
+
+@app.route('/api/dashboard', methods=['GET'])
+@require_auth
+def api_dashboard():
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    # a missing or empty ?fields= (e.g. "?fields=,") means every section
+    fields = fields or list(DASHBOARD_FIELDS)
+    unknown = [f for f in fields if f not in DASHBOARD_FIELDS]
+    if unknown:
+        return jsonify({'error': 'unknown fields: ' + ','.join(unknown)}), 400
+    user = request.user
+    res = {'ok': True}
+    errors = {}
+    pending = {}
+    etag = user_etag(request.db, user, 'dashboard-' + '.'.join(fields))
+    if 'subscription' in fields:
+        res['subscription'] = _subscription_payload(user)
+        # a trial expires with the clock, not with a change to the stored data
+        etag += '-' + res['subscription']['status']
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    if 'invoices' in fields:
+        if not STRIPE_AVAILABLE or not os.environ.get('STRIPE_SECRET_KEY'):
+            errors['invoices'] = 'Stripe not configured on server.'
+        elif not user.stripe_customer_id:
+            res['invoices'] = []
+        else:
+            stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+            pending['invoices'] = dashboard_pool.submit(_fetch_invoices, user.stripe_customer_id)
+    if 'profile' in fields:
+        res['profile'] = _profile_payload(user)
+    for name, fut in pending.items():
+        try:
+            res[name] = fut.result(timeout=DASHBOARD_FETCH_TIMEOUT)
+        except Exception:
+            errors[name] = 'Failed to fetch ' + name
+    if errors:
+        res['errors'] = errors
+        return jsonify(res)
+    return with_etag(jsonify(res), etag)
+
 @app.route('/api/subscribe', methods=['POST'])
 @require_auth
 def api_subscribe():
@@ -301,6 +494,7 @@ def api_subscribe():
             # mock subscription
             user.subscription = json.dumps({'plan': plan, 'status': 'active', 'started': datetime.utcnow().isoformat()})
             db.add(user)
+            bump_user_version(db, user.id)
             db.commit()
             return jsonify({'ok': True, 'subscription': json.loads(user.subscription)})
         stripe.api_key = os.environ['STRIPE_SECRET_KEY']
@@ -308,6 +502,7 @@ def api_subscribe():
             cust = stripe.Customer.create(email=user.email)
             user.stripe_customer_id = cust['id']
             db.add(user)
+            bump_user_version(db, user.id)
             db.commit()
         return jsonify({'error': 'Use /api/create-checkout-session to start Checkout with a PRICE_ID.'}), 501
     finally:
@@ -334,6 +529,7 @@ def api_create_checkout_session():
             cust = stripe.Customer.create(email=user.email)
             user.stripe_customer_id = cust['id']
             db.add(user)
+            bump_user_version(db, user.id)
             db.commit()
         # create checkout session
         success_url = data.get('success_url') or (request.host_url.rstrip('/') + '/dashboard.html')
@@ -378,21 +574,32 @@ def stripe_webhook():
             customer = session.get('customer')
             subscription = session.get('subscription')
             # find user by customer id and store subscription
-            user = db.query(User).filter_by(stripe_customer_id=customer).one_or_none()
+            user_id = _user_id_for_customer(customer)
+            user = db.query(User).get(user_id) if user_id else None
             if user:
                 user.subscription = json.dumps({'subscription_id': subscription, 'status': 'active', 'updated': datetime.utcnow().isoformat()})
                 db.add(user)
+                bump_user_version(db, user.id)
                 db.commit()
         elif typ == 'invoice.payment_succeeded':
             invoice = obj
             customer = invoice.get('customer')
-            user = db.query(User).filter_by(stripe_customer_id=customer).one_or_none()
+            user_id = _user_id_for_customer(customer)
+            user = db.query(User).get(user_id) if user_id else None
             if user:
                 # append invoice record or mark paid
                 sub = json.loads(user.subscription) if user.subscription else {}
                 sub['last_invoice'] = invoice.get('id')
                 user.subscription = json.dumps(sub)
                 db.add(user)
+                bump_user_version(db, user.id)
+                db.commit()
+        elif typ and typ.startswith(('invoice.', 'customer.subscription.')):
+            # any other invoice/subscription change (created, finalized, voided, failed...)
+            # alters what /api/invoices and /api/dashboard return, so invalidate their ETags
+            user_id = _user_id_for_customer(obj.get('customer'))
+            if user_id:
+                bump_user_version(db, user_id)
                 db.commit()
     finally:
         db.close()
@@ -417,6 +624,8 @@ def api_logout():
 
 if __name__ == '__main__':
     print(f'Using DATABASE_URL={DATABASE_URL}')
+    if DATABASE_REPLICA_URL:
+        print(f'Routing read-only queries to DATABASE_REPLICA_URL={DATABASE_REPLICA_URL}')
     if STRIPE_AVAILABLE:
         print('Stripe library is installed; check STRIPE_SECRET_KEY env variable to enable live flows.')
     else: